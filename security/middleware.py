@@ -1,8 +1,11 @@
 # Copyright (c) 2011, SD Elements. See LICENSE.txt for details.
 
+import calendar
+import datetime
 import json
 import logging
-from re import compile
+import re
+import time
 
 import django.conf
 from django.contrib.auth import logout
@@ -19,6 +22,56 @@ from .password_expiry import password_is_expired
 
 logger = logging.getLogger(__name__)
 
+try:
+    _string_types = (basestring,)
+except NameError:  # Python 3
+    _string_types = (str,)
+
+
+class _AnyPattern(object):
+    """
+    Matches a string against several separately compiled regular expressions,
+    returning the first match. Used when the expressions can't be joined into
+    a single pattern.
+    """
+
+    __slots__ = ('patterns',)
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+
+    def match(self, string):
+        for pattern in self.patterns:
+            m = pattern.match(string)
+            if m:
+                return m
+        return None
+
+
+def _compile_alternation(patterns):
+    """
+    Compile a list of regular expressions into a single pattern matching any
+    of them, so that checking a path costs one ``match`` call instead of one
+    per expression. Returns None if the list is empty.
+
+    Expressions with inline flags or groups can't be joined without changing
+    their meaning (a flag would apply to every alternative, and group names
+    and numbers would clash), so such lists are matched one expression at a
+    time instead. So are lists containing anything other than pattern
+    strings, such as already compiled expressions.
+    """
+    patterns = list(patterns or ())
+    if not patterns:
+        return None
+
+    compiled = [re.compile(p) for p in patterns]
+    default_flags = re.compile('').flags
+    if any(not isinstance(p, _string_types) for p in patterns) or \
+            any(c.flags != default_flags or c.groups for c in compiled):
+        return _AnyPattern(compiled)
+
+    return re.compile('|'.join('(?:{0})'.format(c.pattern) for c in compiled))
+
 
 class BaseMiddleware(object):
     """
@@ -110,26 +163,24 @@ class DoNotTrackMiddleware(object):
       <http://tools.ietf.org/html/draft-mayer-do-not-track-00>`_
     """
 
+    __slots__ = ()
+
     def process_request(self, request):
         """
         Read DNT header from browser request and create request attribute
         """
-        if 'HTTP_DNT' in request.META:
-            if request.META['HTTP_DNT'] == '1':
-                request.dnt = True
-            else:
-                request.dnt = False
-        else:
-            request.dnt = None
-            # returns None in normal conditions
+        dnt = request.META.get('HTTP_DNT')
+        # any value other than '1' is an opt-in, a missing header is None
+        request.dnt = None if dnt is None else dnt == '1'
 
     def process_response(self, request, response):
         """
         Echo DNT header in response per section 8.4 of draft-mayer-do-not-
         track-00
         """
-        if 'HTTP_DNT' in request.META:
-            response['DNT'] = request.META['HTTP_DNT']
+        dnt = request.META.get('HTTP_DNT')
+        if dnt is not None:
+            response['DNT'] = dnt
         return response
 
 
@@ -170,27 +221,31 @@ class XssProtectMiddleware(BaseMiddleware):
 
     DEFAULT = 'sanitize'
 
-    def load_setting(self, setting, value):
+    @classmethod
+    def _parse_setting(cls, value):
+        """
+        Return the option and header value for an XSS_PROTECT setting.
+        """
         if not value:
-            self.option = self.DEFAULT
-            return
+            value = cls.DEFAULT
+        else:
+            value = value.lower()
 
-        value = value.lower()
+        if value not in cls.OPTIONS:
+            raise ImproperlyConfigured(
+                cls.__name__ + " invalid option for XSS_PROTECT."
+            )
 
-        if value in self.OPTIONS.keys():
-            self.option = value
-            return
+        return value, cls.OPTIONS[value]
 
-        raise ImproperlyConfigured(
-            self.__class__.__name__ + " invalid option for XSS_PROTECT."
-        )
+    def load_setting(self, setting, value):
+        self.option, self.header_value = self._parse_setting(value)
 
     def process_response(self, request, response):
         """
         Add X-XSS-Protection to the reponse header.
         """
-        header = self.OPTIONS[self.option]
-        response['X-XSS-Protection'] = header
+        response['X-XSS-Protection'] = self.header_value
         return response
 
 
@@ -213,6 +268,8 @@ class ContentNoSniff(object):
       <http://msdn.microsoft.com/en-us/library/ie/gg622941(v=vs.85).aspx>`_
     """
 
+    __slots__ = ()
+
     def process_response(self, request, response):
         """
         And ``X-Content-Options: nosniff`` to the response header.
@@ -237,43 +294,77 @@ class MandatoryPasswordChangeMiddleware(BaseMiddleware):
 
         ``INCLUDE_SUPERUSERS``  also check superusers for password change,
         default False
+
+    A password that is found not to be expired is remembered for
+    ``PASSWORD_CHECK_INTERVAL`` seconds, so that subsequent requests from the
+    same user don't query ``PasswordExpiry`` again. Expired passwords are
+    never remembered, so a changed password takes effect immediately.
     """
 
     OPTIONAL_SETTINGS = ("MANDATORY_PASSWORD_CHANGE",)
 
+    PASSWORD_CHECK_INTERVAL = 60
+    PASSWORD_CHECK_MAX_ENTRIES = 10000
+
     def load_setting(self, setting, value):
         if value and "URL_NAME" not in value:
             raise ImproperlyConfigured(
                 self.__class__.__name__ + " requires the URL_NAME setting"
             )
 
-        self.settings = value
-        self.exempt_urls = [
-            compile(url) for url in self.settings.get("EXEMPT_URLS", ())
-        ]
+        self.settings = value or {}
+        self.exempt_re = _compile_alternation(
+            self.settings.get("EXEMPT_URLS"),
+        )
+        self.exempt_url_names = frozenset(
+            self.settings.get("EXEMPT_URL_NAMES", ()),
+        )
+        # user pk -> time the password was last confirmed not expired
+        self.password_checked = {}
+
+    def _remember_password_checked(self, user_pk, now):
+        checked = self.password_checked
+        if len(checked) >= self.PASSWORD_CHECK_MAX_ENTRIES:
+            cutoff = now - self.PASSWORD_CHECK_INTERVAL
+            for pk, checked_at in list(checked.items()):
+                if checked_at <= cutoff:
+                    # another thread may have pruned it already
+                    checked.pop(pk, None)
+            if len(checked) >= self.PASSWORD_CHECK_MAX_ENTRIES:
+                checked.clear()
+        checked[user_pk] = now
 
     def process_view(self, request, view, *args, **kwargs):
         if not self.settings:
             return
 
-        if not request.user.is_authenticated():
+        user = request.user
+        if not user.is_authenticated():
             return
 
         if view == django.views.static.serve:
             return
 
+        now = time.time()
+        checked_at = self.password_checked.get(user.pk)
+        if (
+            checked_at is not None and
+            now - checked_at < self.PASSWORD_CHECK_INTERVAL
+        ):
+            return
+
         # Check for an exempt URL before trying to resolve URL_NAME,
         # because the reason the URL is exempt may be because a special URL
         # config is in use (i.e. during a test) that doesn't have URL_NAME.
 
-        path = request.path_info.lstrip('/')
-
-        if any(m.match(path) for m in self.exempt_urls):
+        exempt_re = self.exempt_re
+        if exempt_re is not None and \
+                exempt_re.match(request.path_info.lstrip('/')):
             return
 
         url_name = resolve(request.path_info).url_name
 
-        if url_name in self.settings.get("EXEMPT_URL_NAMES", ()):
+        if url_name in self.exempt_url_names:
             return
 
         password_change_url = reverse(self.settings["URL_NAME"])
@@ -281,9 +372,11 @@ class MandatoryPasswordChangeMiddleware(BaseMiddleware):
         if request.path == password_change_url:
             return
 
-        if password_is_expired(request.user):
+        if password_is_expired(user):
             return HttpResponseRedirect(password_change_url)
 
+        self._remember_password_checked(user.pk, now)
+
 
 class NoConfidentialCachingMiddleware(BaseMiddleware):
     """
@@ -319,16 +412,22 @@ class NoConfidentialCachingMiddleware(BaseMiddleware):
 
     OPTIONAL_SETTINGS = ("NO_CONFIDENTIAL_CACHING",)
 
+    NO_CACHE_HEADERS = (
+        ('Cache-control', 'no-cache, no-store, max-age=0, must-revalidate'),
+        ('Pragma', 'no-cache'),
+        ('Expires', -1),
+    )
+
     def load_setting(self, setting, value):
         value = value or {}
         self.whitelist = value.get("WHITELIST_ON", False)
         if self.whitelist:
-            self.whitelist_url_regexes = \
-                [compile(x) for x in value['WHITELIST_REGEXES']]
+            self.whitelist_re = \
+                _compile_alternation(value['WHITELIST_REGEXES'])
         self.blacklist = value.get("BLACKLIST_ON", False)
         if self.blacklist:
-            self.blacklist_url_regexes = \
-                [compile(x) for x in value['BLACKLIST_REGEXES']]
+            self.blacklist_re = \
+                _compile_alternation(value['BLACKLIST_REGEXES'])
 
     def process_response(self, request, response):
         """
@@ -336,23 +435,24 @@ class NoConfidentialCachingMiddleware(BaseMiddleware):
         whitelist non-confidential pages and treat all others as non-
         confidential, or specifically blacklist pages as confidential
         """
+        if not (self.whitelist or self.blacklist):
+            return response
 
-        def match(path, match_list):
-            path = path.lstrip('/')
-            return any(re.match(path) for re in match_list)
-
-        def remove_response_caching(response):
-            response['Cache-control'] = \
-                'no-cache, no-store, max-age=0, must-revalidate'
-            response['Pragma'] = "no-cache"
-            response['Expires'] = -1
+        path = request.path.lstrip('/')
+        confidential = False
 
         if self.whitelist:
-            if not match(request.path, self.whitelist_url_regexes):
-                remove_response_caching(response)
+            whitelist_re = self.whitelist_re
+            if whitelist_re is None or not whitelist_re.match(path):
+                confidential = True
         if self.blacklist:
-            if match(request.path, self.blacklist_url_regexes):
-                remove_response_caching(response)
+            blacklist_re = self.blacklist_re
+            if blacklist_re is not None and blacklist_re.match(path):
+                confidential = True
+
+        if confidential:
+            for header, value in self.NO_CACHE_HEADERS:
+                response[header] = value
         return response
 
 
@@ -393,46 +493,46 @@ class XFrameOptionsMiddleware(BaseMiddleware):
 
     OPTIONAL_SETTINGS = ('X_FRAME_OPTIONS', 'X_FRAME_OPTIONS_EXCLUDE_URLS')
 
+    OPTIONS = ('sameorigin', 'deny')
+
     DEFAULT = 'deny'
 
-    def load_setting(self, setting, value):
-        if setting == 'X_FRAME_OPTIONS':
-            if not value:
-                self.option = XFrameOptionsMiddleware.DEFAULT
-                return
+    @classmethod
+    def _parse_option(cls, value):
+        if not value:
+            return cls.DEFAULT
 
-            value = value.lower()
-            options = ['sameorigin', 'deny']
+        value = value.lower()
 
-            if value in options or value.startswith('allow-from:'):
-                self.option = value
-                return
+        if value in cls.OPTIONS or value.startswith('allow-from:'):
+            return value
 
+        raise ImproperlyConfigured(
+            cls.__name__ + " invalid option for X_FRAME_OPTIONS"
+        )
+
+    @classmethod
+    def _parse_exclude_urls(cls, value):
+        try:
+            return _compile_alternation(value)
+        except TypeError:
             raise ImproperlyConfigured(
-                self.__class__.__name__ + " invalid option for X_FRAME_OPTIONS"
+                cls.__name__ +
+                " invalid option for X_FRAME_OPTIONS_EXCLUDE_URLS",
             )
 
+    def load_setting(self, setting, value):
+        if setting == 'X_FRAME_OPTIONS':
+            self.option = self._parse_option(value)
         elif setting == 'X_FRAME_OPTIONS_EXCLUDE_URLS':
-            if not value:
-                self.exclude_urls = []
-                return
-
-            try:
-                self.exclude_urls = [compile(url) for url in value]
-            except TypeError:
-                raise ImproperlyConfigured(
-                    self.__class__.__name__ +
-                    " invalid option for X_FRAME_OPTIONS_EXCLUDE_URLS",
-                )
+            self.exclude_re = self._parse_exclude_urls(value)
 
     def process_response(self, request, response):
         """
         And X-Frame-Options and Frame-Options to the response header.
         """
-        for url in self.exclude_urls:
-            if url.match(request.path):
-                break
-        else:
+        exclude_re = self.exclude_re
+        if exclude_re is None or not exclude_re.match(request.path):
             response['X-Frame-Options'] = self.option
 
         return response
@@ -590,32 +690,32 @@ class ContentSecurityPolicyMiddleware(object):
             logger.warn('Arguments to %s must be given as list or tuple', key)
             raise django.core.exceptions.MiddlewareNotUsed
 
-        csp_loc_string = "{0}".format(key)
+        csp_loc_parts = [key]
         for loc in value:
             if loc in self._CSP_LOCATIONS:
-                csp_loc_string += " '{0}'".format(loc)  # quoted
+                csp_loc_parts.append("'{0}'".format(loc))  # quoted
             elif loc == '*':
-                csp_loc_string += ' *'                   # not quoted
+                csp_loc_parts.append('*')                    # not quoted
             else:
                 # XXX: check for valid hostname or URL
-                csp_loc_string += " {0}".format(loc)   # not quoted
+                csp_loc_parts.append(loc)                    # not quoted
 
-        return csp_loc_string
+        return ' '.join(csp_loc_parts)
 
     def _csp_sandbox_builder(self, key, value):
         if not isinstance(value, (list, tuple)):
             logger.warn('Arguments to %s must be given as list or tuple', key)
             raise django.core.exceptions.MiddlewareNotUsed
 
-        csp_sandbox_string = "{0}".format(key)
+        csp_sandbox_parts = [key]
         for opt in value:
             if opt in self._CSP_SANDBOX_ARGS:
-                csp_sandbox_string += " {0}".format(opt)
+                csp_sandbox_parts.append(opt)
             else:
                 logger.warn('Invalid CSP sandbox argument %s', opt)
                 raise django.core.exceptions.MiddlewareNotUsed
 
-        return csp_sandbox_string
+        return ' '.join(csp_sandbox_parts)
 
     def _csp_report_uri_builder(self, key, value):
         # XXX: add valid URL check
@@ -672,8 +772,10 @@ class ContentSecurityPolicyMiddleware(object):
 
         if not csp_mode or csp_mode == 'enforce':
             self._enforce = True
+            self._header = 'Content-Security-Policy'
         elif csp_mode == 'report-only':
             self._enforce = False
+            self._header = 'Content-Security-Policy-Report-Only'
         else:
             logger.warn(
                 'Invalid CSP_MODE %s, "enforce" or "report-only" allowed',
@@ -701,21 +803,17 @@ class ContentSecurityPolicyMiddleware(object):
         And Content Security Policy policy to the response header. Use either
         enforcement or report-only headers in all currently used variants.
         """
-        # choose headers based enforcement mode
-        is_ie = False
-        if 'HTTP_USER_AGENT' in request.META:
-            parsed_ua = user_agent_parser.ParseUserAgent(request.META['HTTP_USER_AGENT'])
-            is_ie = parsed_ua['family'] == 'IE'
+        header = self._header
 
+        # only enforced policies use a different header for IE, so don't
+        # parse the user agent in report-only mode
         if self._enforce:
-            if is_ie:
-                header = 'X-Content-Security-Policy'
-            else:
-                header = 'Content-Security-Policy'
-        else:
-            header = 'Content-Security-Policy-Report-Only'
+            user_agent = request.META.get('HTTP_USER_AGENT')
+            if user_agent is not None:
+                parsed_ua = user_agent_parser.ParseUserAgent(user_agent)
+                if parsed_ua['family'] == 'IE':
+                    header = 'X-Content-Security-Policy'
 
-        # actually add appropriate headers
         response[header] = self._csp_string
 
         return response
@@ -746,29 +844,52 @@ class StrictTransportSecurityMiddleware(object):
     _ `Preloaded HSTS sites <http://www.chromium.org/sts>`_
     """
 
+    __slots__ = ('max_age', 'subdomains', 'preload', 'value')
+
     def __init__(self):
+        self.max_age, self.subdomains, self.preload = self._read_settings()
+        self.value = self._build_value(
+            self.max_age,
+            self.subdomains,
+            self.preload,
+        )
+
+    @staticmethod
+    def _read_settings():
+        """
+        Return the max age, subdomains and preload settings, with defaults.
+        """
         try:
-            self.max_age = django.conf.settings.STS_MAX_AGE
+            max_age = django.conf.settings.STS_MAX_AGE
         except AttributeError:
-            self.max_age = 3600 * 24 * 365  # one year
+            max_age = 3600 * 24 * 365  # one year
 
         try:
-            self.subdomains = django.conf.settings.STS_INCLUDE_SUBDOMAINS
+            subdomains = django.conf.settings.STS_INCLUDE_SUBDOMAINS
         except AttributeError:
-            self.subdomains = True
+            subdomains = True
 
         try:
-            self.preload = django.conf.settings.STS_PRELOAD
+            preload = django.conf.settings.STS_PRELOAD
         except AttributeError:
-            self.preload = True
+            preload = True
+
+        return max_age, subdomains, preload
+
+    @staticmethod
+    def _build_value(max_age, subdomains, preload):
+        """
+        Return the Strict-Transport-Security header value.
+        """
+        value = 'max-age={0}'.format(max_age)
 
-        self.value = 'max-age={0}'.format(self.max_age)
+        if subdomains:
+            value += ' ; includeSubDomains'
 
-        if self.subdomains:
-            self.value += ' ; includeSubDomains'
+        if preload:
+            value += ' ; preload'
 
-        if self.preload:
-            self.value += ' ; preload'
+        return value
 
     def process_response(self, request, response):
         """
@@ -778,6 +899,67 @@ class StrictTransportSecurityMiddleware(object):
         return response
 
 
+class SecurityHeadersMiddleware(BaseMiddleware):
+    """
+    Adds the headers of XssProtectMiddleware, ContentNoSniff,
+    XFrameOptionsMiddleware and StrictTransportSecurityMiddleware from a
+    single middleware. It reads the same settings as those four
+    (``XSS_PROTECT``, ``X_FRAME_OPTIONS``, ``X_FRAME_OPTIONS_EXCLUDE_URLS``,
+    ``STS_MAX_AGE``, ``STS_INCLUDE_SUBDOMAINS`` and ``STS_PRELOAD``) and sets
+    the same headers.
+
+    Use it **instead of** the individual middlewares, not alongside them: one
+    middleware call per response is cheaper than four.
+    """
+
+    _STS_SETTINGS = ('STS_MAX_AGE', 'STS_INCLUDE_SUBDOMAINS', 'STS_PRELOAD')
+
+    OPTIONAL_SETTINGS = (
+        XssProtectMiddleware.OPTIONAL_SETTINGS +
+        XFrameOptionsMiddleware.OPTIONAL_SETTINGS +
+        _STS_SETTINGS
+    )
+
+    xss_header_value = None
+    sts_value = None
+    frame_option = None
+    frame_exclude_re = None
+
+    def load_setting(self, setting, value):
+        if setting == 'XSS_PROTECT':
+            _, self.xss_header_value = \
+                XssProtectMiddleware._parse_setting(value)
+        elif setting == 'X_FRAME_OPTIONS':
+            self.frame_option = XFrameOptionsMiddleware._parse_option(value)
+        elif setting == 'X_FRAME_OPTIONS_EXCLUDE_URLS':
+            self.frame_exclude_re = \
+                XFrameOptionsMiddleware._parse_exclude_urls(value)
+        elif setting in self._STS_SETTINGS:
+            # the header value depends on all three STS settings
+            sts = StrictTransportSecurityMiddleware
+            self.sts_value = sts._build_value(*sts._read_settings())
+
+        self.headers = (
+            ('X-XSS-Protection', self.xss_header_value),
+            ('X-Content-Options', 'nosniff'),
+            ('Strict-Transport-Security', self.sts_value),
+        )
+
+    def process_response(self, request, response):
+        """
+        Add all security headers to the response.
+        """
+        for header, value in self.headers:
+            response[header] = value
+
+        frame_exclude_re = self.frame_exclude_re
+        if frame_exclude_re is None or \
+                not frame_exclude_re.match(request.path):
+            response['X-Frame-Options'] = self.frame_option
+
+        return response
+
+
 class P3PPolicyMiddleware(BaseMiddleware):
     """
     Adds the HTTP header attribute specifying compact P3P policy
@@ -798,20 +980,25 @@ class P3PPolicyMiddleware(BaseMiddleware):
     REQUIRED_SETTINGS = ("P3P_COMPACT_POLICY",)
     OPTIONAL_SETTINGS = ("P3P_POLICY_URL",)
 
+    policy = None
+    policy_url = '/w3c/p3p.xml'
+
     def load_setting(self, setting, value):
         if setting == 'P3P_COMPACT_POLICY':
             self.policy = value
         elif setting == 'P3P_POLICY_URL':
             self.policy_url = value or '/w3c/p3p.xml'
 
+        self.header_value = 'policyref="{0}" CP="{1}"'.format(
+            self.policy_url,
+            self.policy,
+        )
+
     def process_response(self, request, response):
         """
         And P3P policy to the response header.
         """
-        response['P3P'] = 'policyref="{0}" CP="{1}"'.format(
-            self.policy_url,
-            self.policy,
-        )
+        response['P3P'] = self.header_value
         return response
 
 
@@ -824,20 +1011,37 @@ class SessionExpiryPolicyMiddleware(BaseMiddleware):
     and SESSION_INACTIVITY_TIMEOUT from the settings.py file to determine
     how long to keep a session alive.
 
+    The last activity time is only refreshed once it is more than
+    SESSION_ACTIVITY_RESOLUTION seconds old (default: 60), so that frequent
+    requests don't force a session save every time. Set it to 0 to refresh
+    on every request. It is capped at half of SESSION_INACTIVITY_TIMEOUT, so
+    that active users are never logged out for inactivity.
+
     We will purge a session that has expired. This middleware should be run
     before the LoginRequired middelware if you want to redirect the expired
     session to the login page (if required).
+
+    The start and last activity times are kept in the session as seconds
+    since the epoch (``time.time()``).
     """
 
-    OPTIONAL_SETTINGS = ('SESSION_COOKIE_AGE', 'SESSION_INACTIVITY_TIMEOUT')
+    OPTIONAL_SETTINGS = (
+        'SESSION_COOKIE_AGE',
+        'SESSION_INACTIVITY_TIMEOUT',
+        'SESSION_ACTIVITY_RESOLUTION',
+    )
 
     SECONDS_PER_DAY = 86400
     SECONDS_PER_30MINS = 1800
+    SECONDS_PER_MINUTE = 60
 
     # Session keys
     START_TIME_KEY = 'starttime'
     LAST_ACTIVITY_KEY = 'lastactivity'
 
+    # SESSION_ACTIVITY_RESOLUTION as configured, before capping
+    activity_resolution = SECONDS_PER_MINUTE
+
     def load_setting(self, setting, value):
         if setting == 'SESSION_COOKIE_AGE':
             self.SESSION_COOKIE_AGE = value or self.SECONDS_PER_DAY
@@ -850,6 +1054,29 @@ class SessionExpiryPolicyMiddleware(BaseMiddleware):
             logger.debug("Session Inactivity Timeout is %d seconds",
                          self.SESSION_INACTIVITY_TIMEOUT
                          )
+        elif setting == 'SESSION_ACTIVITY_RESOLUTION':
+            if value is None:
+                value = self.SECONDS_PER_MINUTE
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ImproperlyConfigured(
+                    self.__class__.__name__ +
+                    " invalid option for SESSION_ACTIVITY_RESOLUTION"
+                )
+            self.activity_resolution = value
+
+        if setting in (
+            'SESSION_INACTIVITY_TIMEOUT',
+            'SESSION_ACTIVITY_RESOLUTION',
+        ):
+            # Refreshing less often than the timeout would log out users who
+            # are still making requests.
+            self.SESSION_ACTIVITY_RESOLUTION = min(
+                self.activity_resolution,
+                self.SESSION_INACTIVITY_TIMEOUT // 2,
+            )
+            logger.debug("Session Activity Resolution is %d seconds",
+                         self.SESSION_ACTIVITY_RESOLUTION
+                         )
 
     def process_request(self, request):
         """
@@ -858,56 +1085,83 @@ class SessionExpiryPolicyMiddleware(BaseMiddleware):
         is the case. We set the last activity time to now() if the session
         is still active.
         """
-        if (
-            self.START_TIME_KEY not in request.session or
-            self.LAST_ACTIVITY_KEY not in request.session or
-            timezone.is_naive(request.session[self.START_TIME_KEY]) or
-            timezone.is_naive(request.session[self.LAST_ACTIVITY_KEY])
-        ):
+        session = request.session
+        stored_start_time = session.get(self.START_TIME_KEY)
+        stored_last_activity_time = session.get(self.LAST_ACTIVITY_KEY)
+        start_time = self._to_timestamp(stored_start_time)
+        last_activity_time = self._to_timestamp(stored_last_activity_time)
+
+        if start_time is None or last_activity_time is None:
             self.process_new_session(request)
-        else:
-            self.process_existing_session(request)
+            return
+
+        # Sessions written by older versions hold aware datetimes; store them
+        # back as timestamps so they're only converted once.
+        if start_time is not stored_start_time:
+            session[self.START_TIME_KEY] = start_time
+        if last_activity_time is not stored_last_activity_time:
+            session[self.LAST_ACTIVITY_KEY] = last_activity_time
+
+        self.process_existing_session(request)
+
+    @staticmethod
+    def _to_timestamp(value):
+        """
+        Return a stored session time as seconds since the epoch, or None if it
+        can't be used (missing, or a naive datetime).
+        """
+        if isinstance(value, float):
+            return value
+        if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+            return (
+                calendar.timegm(value.utctimetuple()) +
+                value.microsecond / 1e6
+            )
+        return None
 
     def process_new_session(self, request):
-        now = timezone.now()
+        now = time.time()
         session = request.session
-        logger.debug("New session %s started: %s", session.session_key, now)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("New session %s started: %s",
+                         session.session_key, now)
         session[self.START_TIME_KEY] = now
         session[self.LAST_ACTIVITY_KEY] = now
 
     def process_existing_session(self, request):
-        now = timezone.now()
+        now = time.time()
         session = request.session
         start_time = session[self.START_TIME_KEY]
         last_activity_time = session[self.LAST_ACTIVITY_KEY]
 
-        logger.debug("Session %s started: %s",
-                     session.session_key,
-                     start_time
-                     )
-        logger.debug("Session %s last active: %s",
-                     session.session_key,
-                     last_activity_time
-                     )
+        # Checked once up front: session_key is a property and these calls
+        # would otherwise run on every request even with DEBUG disabled.
+        debug = logger.isEnabledFor(logging.DEBUG)
 
-        session_age = self.get_diff_in_seconds(now, start_time)
-        session_too_old = session_age > self.SESSION_COOKIE_AGE
+        if debug:
+            logger.debug("Session %s started: %s, last active: %s",
+                         session.session_key,
+                         start_time,
+                         last_activity_time
+                         )
 
-        session_lastactive = self.get_diff_in_seconds(now, last_activity_time)
-        session_inactive = session_lastactive > self.SESSION_INACTIVITY_TIMEOUT
+        session_too_old = now - start_time > self.SESSION_COOKIE_AGE
+        session_inactive = \
+            now - last_activity_time > self.SESSION_INACTIVITY_TIMEOUT
 
         if session_too_old or session_inactive:
-            logger.debug("Session %s is inactive.", session.session_key)
+            if debug:
+                logger.debug("Session %s is inactive.", session.session_key)
             logout(request)
             return
 
-        logger.debug("Session %s is still active.", session.session_key)
-        session[self.LAST_ACTIVITY_KEY] = now
+        if debug:
+            logger.debug("Session %s is still active.", session.session_key)
 
-    def get_diff_in_seconds(self, now, time):
-        diff = now - time
-        age = diff.days * self.SECONDS_PER_DAY + diff.seconds
-        return age
+        # Leave the session untouched (and so unsaved) unless the recorded
+        # activity is stale enough to matter.
+        if now - last_activity_time > self.SESSION_ACTIVITY_RESOLUTION:
+            session[self.LAST_ACTIVITY_KEY] = now
 
 # Modified a little bit by us.
 
@@ -958,7 +1212,7 @@ class LoginRequiredMiddleware(BaseMiddleware):
         if setting == 'LOGIN_URL':
             self.login_url = value
         elif setting == 'LOGIN_EXEMPT_URLS':
-            self.exempt_urls = [compile(expr) for expr in (value or ())]
+            self.exempt_re = _compile_alternation(value)
 
     def process_request(self, request):
         if not hasattr(request, 'user'):
@@ -967,15 +1221,17 @@ class LoginRequiredMiddleware(BaseMiddleware):
                 "requires authentication middleware to be installed."
             )
 
-        if request.user.is_authenticated() and not request.user.is_active:
+        user = request.user
+        if user.is_authenticated():
+            if user.is_active:
+                return
+            # Inactive users are logged out and then treated like any other
+            # anonymous request below.
             logout(request)
 
-        if request.user.is_authenticated():
-            return
-
-        path = request.path_info.lstrip('/')
-
-        if any(m.match(path) for m in self.exempt_urls):
+        exempt_re = self.exempt_re
+        if exempt_re is not None and \
+                exempt_re.match(request.path_info.lstrip('/')):
             return
 
         if hasattr(request, 'login_url'):
@@ -1038,24 +1294,23 @@ class ReferrerPolicyMiddleware(BaseMiddleware):
 
     def load_setting(self, setting, value):
         if not value:
-            self.option = self.DEFAULT
-            return
-
-        value = value.lower()
+            value = self.DEFAULT
+        else:
+            value = value.lower()
 
-        if value in self.OPTIONS:
-            self.option = value
-            return
+        if value not in self.OPTIONS:
+            raise ImproperlyConfigured(
+                self.__class__.__name__ +
+                " invalid option for REFERRER_POLICY."
+            )
 
-        raise ImproperlyConfigured(
-            self.__class__.__name__ + " invalid option for REFERRER_POLICY."
-        )
+        self.option = value
+        self.header_value = None if value == 'off' else value
 
     def process_response(self, request, response):
         """
         Add Referrer-Policy to the reponse header.
         """
-        if self.option != 'off':
-            header = self.option
-            response['Referrer-Policy'] = header
+        if self.header_value is not None:
+            response['Referrer-Policy'] = self.header_value
         return response
@@ -2,6 +2,7 @@
 
 import datetime
 import json
+import re
 import time  # We monkeypatch this.
 
 from django.contrib.auth.models import User
@@ -22,7 +23,9 @@ from security.auth_throttling import (
 from security.middleware import (
     BaseMiddleware, ContentSecurityPolicyMiddleware, DoNotTrackMiddleware,
     SessionExpiryPolicyMiddleware, MandatoryPasswordChangeMiddleware,
-    XssProtectMiddleware, XFrameOptionsMiddleware, ReferrerPolicyMiddleware
+    XssProtectMiddleware, XFrameOptionsMiddleware, ReferrerPolicyMiddleware,
+    SecurityHeadersMiddleware, StrictTransportSecurityMiddleware,
+    LoginRequiredMiddleware
 )
 from security.models import PasswordExpiry
 from security.password_expiry import never_expire_password
@@ -170,6 +173,33 @@ class LoginRequiredMiddlewareTests(TestCase):
                 {"login_url": '/custom-login/'},
             )
 
+    def test_exempt_urls_with_inline_flags(self):
+        """
+        An inline flag on one exempt URL applies to that URL only.
+        """
+        middleware = LoginRequiredMiddleware()
+        middleware.load_setting(
+            'LOGIN_EXEMPT_URLS',
+            ['(?i)admin/', 'public/', '(?P<page>help)/'],
+        )
+        self.assertTrue(middleware.exempt_re.match('ADMIN/'))
+        self.assertTrue(middleware.exempt_re.match('public/'))
+        self.assertTrue(middleware.exempt_re.match('help/'))
+        self.assertFalse(middleware.exempt_re.match('PUBLIC/'))
+
+    def test_exempt_urls_precompiled(self):
+        """
+        Already compiled expressions are accepted in LOGIN_EXEMPT_URLS.
+        """
+        middleware = LoginRequiredMiddleware()
+        middleware.load_setting(
+            'LOGIN_EXEMPT_URLS',
+            [re.compile('^static/'), 'public/'],
+        )
+        self.assertTrue(middleware.exempt_re.match('static/x'))
+        self.assertTrue(middleware.exempt_re.match('public/'))
+        self.assertFalse(middleware.exempt_re.match('private/'))
+
     def test_logs_out_inactive_users(self):
         user = User.objects.create_user(
             username="foo",
@@ -235,6 +265,52 @@ class RequirePasswordChangeTests(TestCase):
             self.client.logout()
             user.delete()
 
+    def test_password_check_is_remembered(self):
+        """
+        A password found not to be expired isn't checked again until
+        PASSWORD_CHECK_INTERVAL has passed.
+        """
+        user = User.objects.create_user(username="foo",
+                                        password="foo",
+                                        email="foo@foo.com")
+        never_expire_password(user)
+        self.client.login(username="foo", password="foo")
+        old_time = time.time
+        now = [old_time()]
+        time.time = lambda: now[0]
+        try:
+            with self.settings(
+                MANDATORY_PASSWORD_CHANGE={"URL_NAME": "change_password"}
+            ):
+                self.assertEqual(self.client.get("/home/").status_code, 200)
+                PasswordExpiry.objects.filter(user=user).update(
+                    password_expiry_date=timezone.now(),
+                )
+                self.assertEqual(self.client.get("/home/").status_code, 200)
+                now[0] += MandatoryPasswordChangeMiddleware.\
+                    PASSWORD_CHECK_INTERVAL
+                self.assertRedirects(
+                    self.client.get("/home/"),
+                    reverse("change_password"),
+                )
+        finally:
+            time.time = old_time
+            self.client.logout()
+            user.delete()
+
+    def test_password_check_eviction(self):
+        """
+        Once PASSWORD_CHECK_MAX_ENTRIES is reached, stale entries are dropped
+        and fresh ones kept.
+        """
+        middleware = MandatoryPasswordChangeMiddleware()
+        middleware.PASSWORD_CHECK_MAX_ENTRIES = 2
+        now = time.time()
+        stale = now - middleware.PASSWORD_CHECK_INTERVAL - 1
+        middleware.password_checked = {1: stale, 2: now}
+        middleware._remember_password_checked(3, now)
+        self.assertEqual(middleware.password_checked, {2: now, 3: now})
+
     def test_dont_redirect_exempt_urls(self):
         user = User.objects.create_user(
             username="foo",
@@ -325,7 +401,7 @@ class SessionExpiryTests(TestCase):
         Verify the session cookie stores the start time and last active time.
         """
         self.client.get('/home/')
-        now = timezone.now()
+        now = time.time()
 
         start_time = self.client.session[
             SessionExpiryPolicyMiddleware.START_TIME_KEY
@@ -334,8 +410,63 @@ class SessionExpiryTests(TestCase):
             SessionExpiryPolicyMiddleware.LAST_ACTIVITY_KEY
         ]
 
-        self.assertTrue(now - start_time < datetime.timedelta(seconds=10))
-        self.assertTrue(now - last_activity < datetime.timedelta(seconds=10))
+        self.assertTrue(now - start_time < 10)
+        self.assertTrue(now - last_activity < 10)
+
+    def test_last_activity_refresh_is_throttled(self):
+        """
+        Verify the last active time is only rewritten once it is older than
+        SESSION_ACTIVITY_RESOLUTION.
+        """
+        key = SessionExpiryPolicyMiddleware.LAST_ACTIVITY_KEY
+        self.client.get('/home/')
+        last_activity = self.client.session[key]
+
+        self.client.get('/home/')
+        self.assertEqual(self.client.session[key], last_activity)
+
+        session = self.client.session
+        session[key] = last_activity - (
+            SessionExpiryPolicyMiddleware().SESSION_ACTIVITY_RESOLUTION + 1
+        )
+        session.save()
+        self.client.get('/home/')
+        self.assertTrue(self.client.session[key] >= last_activity)
+
+    def test_activity_resolution_capped_by_inactivity_timeout(self):
+        with self.settings(SESSION_INACTIVITY_TIMEOUT=60):
+            middleware = SessionExpiryPolicyMiddleware()
+            self.assertEqual(middleware.SESSION_ACTIVITY_RESOLUTION, 30)
+
+    def test_invalid_activity_resolution_raises(self):
+        middleware = SessionExpiryPolicyMiddleware()
+        self.assertRaises(
+            ImproperlyConfigured,
+            middleware.load_setting,
+            'SESSION_ACTIVITY_RESOLUTION',
+            -1,
+        )
+
+    @login_user
+    def test_active_session_survives_short_inactivity_timeout(self):
+        """
+        Requests spaced less than SESSION_INACTIVITY_TIMEOUT apart keep the
+        session alive, even when the timeout is no longer than the default
+        SESSION_ACTIVITY_RESOLUTION.
+        """
+        old_time = time.time
+        now = [old_time()]
+        time.time = lambda: now[0]
+        try:
+            with self.settings(SESSION_INACTIVITY_TIMEOUT=60):
+                for _ in range(4):
+                    self.assertEqual(
+                        self.client.get('/home/').status_code,
+                        200,
+                    )
+                    now[0] += 40
+        finally:
+            time.time = old_time
 
     def session_expiry_test(self, key, expired):
         """
@@ -357,7 +488,7 @@ class SessionExpiryTests(TestCase):
         session is cleared.
         """
         delta = SessionExpiryPolicyMiddleware().SESSION_COOKIE_AGE + 1
-        expired = timezone.now() - datetime.timedelta(seconds=delta)
+        expired = time.time() - delta
         self.session_expiry_test(SessionExpiryPolicyMiddleware.START_TIME_KEY,
                                  expired)
 
@@ -368,12 +499,23 @@ class SessionExpiryTests(TestCase):
         sure the session is cleared.
         """
         delta = SessionExpiryPolicyMiddleware().SESSION_INACTIVITY_TIMEOUT + 1
-        expired = timezone.now() - datetime.timedelta(seconds=delta)
+        expired = time.time() - delta
         self.session_expiry_test(
             SessionExpiryPolicyMiddleware().LAST_ACTIVITY_KEY,
             expired,
         )
 
+    @login_user
+    def test_datetime_session_too_old(self):
+        """
+        Sessions written with datetime start times by older versions are
+        still expired.
+        """
+        delta = SessionExpiryPolicyMiddleware().SESSION_COOKIE_AGE + 1
+        expired = timezone.now() - datetime.timedelta(seconds=delta)
+        self.session_expiry_test(SessionExpiryPolicyMiddleware.START_TIME_KEY,
+                                 expired)
+
 
 class ConfidentialCachingTests(TestCase):
     def setUp(self):
@@ -419,6 +561,21 @@ class ConfidentialCachingTests(TestCase):
             self.assertEqual(response.get(header, None), value)
 
 
+    def test_setting_change_after_first_request(self):
+        # No list enabled: the response is left alone.
+        response = self.client.get("/accounts/logout/")
+        for header, value in self.header_values.items():
+            self.assertNotEqual(response.get(header, None), value)
+        # Enabling the blacklist on the same client must take effect.
+        with self.settings(NO_CONFIDENTIAL_CACHING={
+            "BLACKLIST_ON": True,
+            "BLACKLIST_REGEXES": ["accounts/logout/$"],
+        }):
+            response = self.client.get("/accounts/logout/")
+            for header, value in self.header_values.items():
+                self.assertEqual(response.get(header, None), value)
+
+
 class XFrameOptionsDenyTests(TestCase):
 
     def test_option_set(self):
@@ -520,6 +677,53 @@ class StrictTransportSecurityTests(TestCase):
         self.assertNotEqual(response['Strict-Transport-Security'], None)
 
 
+class SecurityHeadersTests(TestCase):
+
+    def setUp(self):
+        self.middleware = SecurityHeadersMiddleware()
+        self.request = HttpRequest()
+        self.response = HttpResponse()
+
+    def test_headers_set(self):
+        self.request.path = '/home/'
+        self.middleware.process_response(self.request, self.response)
+        self.assertEqual(self.response['X-XSS-Protection'], '1; mode=block')
+        self.assertEqual(self.response['X-Content-Options'], 'nosniff')
+        self.assertEqual(
+            self.response['X-Frame-Options'],
+            settings.X_FRAME_OPTIONS,
+        )
+        self.assertEqual(
+            self.response['Strict-Transport-Security'],
+            StrictTransportSecurityMiddleware().value,
+        )
+
+    def test_exclude_urls(self):
+        self.request.path = '/test1/'
+        self.middleware.process_response(self.request, self.response)
+        self.assertNotIn('X-Frame-Options', self.response)
+        self.assertIn('X-XSS-Protection', self.response)
+
+    def test_frame_option_change(self):
+        with self.settings(X_FRAME_OPTIONS='sameorigin'):
+            self.middleware.process_response(self.request, self.response)
+            frame_headers = [
+                value for header, value in self.response.items()
+                if header.lower() == 'x-frame-options'
+            ]
+            self.assertEqual(frame_headers, ['sameorigin'])
+
+    def test_setting_change(self):
+        with self.settings(XSS_PROTECT='off', STS_MAX_AGE=60):
+            self.middleware.process_response(self.request, self.response)
+            self.assertEqual(self.response['X-XSS-Protection'], '0')
+            self.assertTrue(
+                self.response['Strict-Transport-Security'].startswith(
+                    'max-age=60',
+                ),
+            )
+
+
 @override_settings(AUTHENTICATION_THROTTLING={
     "DELAY_FUNCTION": lambda x, _: (2 ** (x - 1) if x else 0, 0),
     "LOGIN_URLS_WITH_TEMPLATES": [